@@ -1,12 +1,24 @@
 import os
 import io
-import imghdr
+import hashlib
 import logging
+import random
+import secrets
+import time
 import asyncio
-from typing import List, Optional, Dict
+import concurrent.futures
+import importlib.util
+import weakref
+from typing import List, Optional, Dict, Tuple
 
+import httpx
 from PIL import Image
 
+try:
+    import pyvips  # optional: libvips থাকলে decode-while-shrink
+except (ImportError, OSError):
+    pyvips = None
+
 from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import (
@@ -18,7 +30,7 @@ from telegram.ext import (
 )
 
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 
 
 # ----------------- Config -----------------
@@ -29,6 +41,14 @@ MODEL = "gemini-2.5-flash-image"
 MAX_IMAGES = 3
 MAX_SIDE = 1536  # বড় ছবি হলে resize করে পাঠাবো (speed + reliability)
 
+# downscale filter: LANCZOS (best) / BICUBIC (~2x faster) / BOX (fastest)
+RESAMPLE_FILTERS = {
+    "LANCZOS": Image.LANCZOS,
+    "BICUBIC": Image.BICUBIC,
+    "BOX": Image.BOX,
+}
+RESAMPLE = RESAMPLE_FILTERS.get(os.getenv("RESAMPLE_FILTER", "LANCZOS").upper(), Image.LANCZOS)
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
@@ -38,62 +58,348 @@ if not TELEGRAM_BOT_TOKEN:
 if not GEMINI_API_KEY:
     raise RuntimeError("Missing GEMINI_API_KEY env var")
 
-client = genai.Client(api_key=GEMINI_API_KEY)
+# keep-alive pool reuse করি, প্রতি call-এ নতুন TCP+TLS handshake না হয়
+# (HTTP/2 শুধু h2 package থাকলে)
+GEMINI_HTTP2 = importlib.util.find_spec("h2") is not None
+GEMINI_TIMEOUT_MS = 120_000
+gemini_transport = httpx.AsyncHTTPTransport(
+    http2=GEMINI_HTTP2,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=120),
+    retries=0,
+)
+
+client = genai.Client(
+    api_key=GEMINI_API_KEY,
+    http_options=types.HttpOptions(
+        # ms; genai প্রতিটা request-এ নিজেই timeout দেয়, তাই client args-এ না দিয়ে এখানে
+        timeout=GEMINI_TIMEOUT_MS,
+        async_client_args={"transport": gemini_transport},
+    ),
+)
+
+# Gemini: max concurrent requests + retry on transient errors (429/5xx/timeout)
+GEMINI_MAX_CONCURRENCY = 10
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRY_CODES = {429, 500, 502, 503, 504}
+GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# CPU-bound image work (decode/resize) runs here so the event loop stays free
+DOWNSCALE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
 
 # per-user generation lock (avoid overlapping runs)
-USER_LOCKS: Dict[int, asyncio.Lock] = {}
+# weak values: idle locks get GC'd, তাই user বাড়লেও dict চিরকাল বাড়ে না;
+# held lock-গুলোর strong ref _HELD_LOCKS-এ থাকে যতক্ষণ generation চলে
+USER_LOCKS: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+_HELD_LOCKS: Dict[int, asyncio.Lock] = {}
 
 
 def _get_lock(user_id: int) -> asyncio.Lock:
-    if user_id not in USER_LOCKS:
-        USER_LOCKS[user_id] = asyncio.Lock()
-    return USER_LOCKS[user_id]
+    lock = USER_LOCKS.get(user_id)
+    if lock is None:
+        lock = USER_LOCKS[user_id] = asyncio.Lock()
+    return lock
+
+
+# REDIS_URL দিলে per-user state (image handles, prompt, lock) Redis-এ থাকে,
+# তাহলে একাধিক worker process চালানো যায়; না দিলে in-process user_data
+REDIS_URL = os.getenv("REDIS_URL")
+STATE_TTL = 3600  # seconds
+PROJECT_TTL = 7 * 24 * 3600  # project id; in-flight upload-এর চেয়ে অনেক বেশি দিন
+LOCK_TTL_MS = 60_000  # generation চলাকালীন _keep_user_lock প্রতি TTL/3-এ বাড়ায়
+
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as aioredis
+
+    redis_client = aioredis.from_url(REDIS_URL)
+
+# lock value = এই worker-এর random token; শুধু নিজের token মিললে extend/delete করি,
+# যাতে expire হয়ে অন্য worker lock নিলে সেটা ভুল করে ছেড়ে না দিই
+_LOCK_TOKENS: Dict[int, str] = {}
+_RELEASE_LOCK_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+_EXTEND_LOCK_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_ADD_IMAGE_LUA = """
+if (redis.call("get", KEYS[1]) or "0") ~= ARGV[1] then
+    return -1
+end
+local n = redis.call("rpush", KEYS[2], ARGV[2])
+redis.call("expire", KEYS[2], ARGV[3])
+return n
+"""
+_release_lock_script = redis_client.register_script(_RELEASE_LOCK_LUA) if redis_client else None
+_extend_lock_script = redis_client.register_script(_EXTEND_LOCK_LUA) if redis_client else None
+_add_image_script = redis_client.register_script(_ADD_IMAGE_LUA) if redis_client else None
+
+
+async def _try_acquire_user_lock(user_id: int) -> bool:
+    if redis_client is None:
+        lock = _get_lock(user_id)
+        if lock.locked():
+            return False
+        await lock.acquire()
+        _HELD_LOCKS[user_id] = lock
+        return True
+    token = secrets.token_hex(16)
+    if not await redis_client.set(f"lock:{user_id}", token, nx=True, px=LOCK_TTL_MS):
+        return False
+    _LOCK_TOKENS[user_id] = token
+    return True
+
+
+async def _keep_user_lock(user_id: int):
+    """Generation যতক্ষণ চলে, Redis lock-এর TTL বাড়াতে থাকি"""
+    token = _LOCK_TOKENS.get(user_id)
+    if redis_client is None or token is None:
+        return
+    while True:
+        await asyncio.sleep(LOCK_TTL_MS / 3000)
+        try:
+            extended = await _extend_lock_script(keys=[f"lock:{user_id}"], args=[token, LOCK_TTL_MS])
+        except Exception:
+            log.warning("Failed to extend generation lock for user %s", user_id, exc_info=True)
+            continue
+        if not extended:
+            log.warning("Generation lock for user %s expired or was taken over", user_id)
+            return
+
+
+async def _is_user_locked(user_id: int) -> bool:
+    if redis_client is None:
+        return user_id in _HELD_LOCKS
+    return bool(await redis_client.exists(f"lock:{user_id}"))
+
+
+async def _release_user_lock(user_id: int):
+    if redis_client is None:
+        _HELD_LOCKS.pop(user_id).release()
+        return
+    token = _LOCK_TOKENS.pop(user_id, None)
+    if token is not None:
+        await _release_lock_script(keys=[f"lock:{user_id}"], args=[token])
 
 
 # ----------------- Helpers -----------------
 def _guess_mime(b: bytes) -> str:
-    k = imghdr.what(None, h=b)
-    if k == "png":
+    # magic bytes দেখে format (imghdr Python 3.13-এ নেই)
+    h = bytes(b[:12])
+    if h[:8] == b"\x89PNG\r\n\x1a\n":
         return "image/png"
-    if k in ("jpeg", "jpg"):
+    if h[:3] == b"\xff\xd8\xff":
         return "image/jpeg"
-    if k == "webp":
+    if h[:4] == b"RIFF" and h[8:12] == b"WEBP":
         return "image/webp"
     return "image/jpeg"
 
 
-def _downscale_image_bytes(image_bytes: bytes) -> bytes:
+def _downscale_with_vips(
+    image_bytes: bytes, mime: str
+) -> Tuple[bytes, str]:
+    # header-only open; ছোট ছবি হলে pixel decode-ই হয় না
+    head = pyvips.Image.new_from_buffer(image_bytes, "", access="sequential")
+    if max(head.width, head.height) <= MAX_SIDE:
+        return image_bytes, mime
+
+    # thumbnail_buffer JPEG-এ shrink-on-load করে, তারপর tile ধরে stream করে resize
+    img = pyvips.Image.thumbnail_buffer(image_bytes, MAX_SIDE, height=MAX_SIDE, size="down")
+    if img.hasalpha():
+        img = img.flatten()
+    if img.interpretation != "srgb":
+        img = img.colourspace("srgb")
+    return img.write_to_buffer(".jpg[Q=92]"), "image/jpeg"
+
+
+def _downscale_image_bytes(
+    image_bytes: bytes, mime: str
+) -> Tuple[bytes, str]:
     """Telegram photo কখনও বড় হলে downscale করে model-এ পাঠাই"""
+    if pyvips is not None:
+        try:
+            return _downscale_with_vips(image_bytes, mime)
+        except Exception:
+            log.warning("libvips downscale failed, falling back to Pillow", exc_info=True)
+    return _downscale_with_pillow(image_bytes, mime)
+
+
+def _downscale_with_pillow(
+    image_bytes: bytes, mime: str
+) -> Tuple[bytes, str]:
     try:
-        img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        w, h = img.size
-        m = max(w, h)
-        if m <= MAX_SIDE:
-            return image_bytes
+        with Image.open(io.BytesIO(image_bytes)) as im:
+            # .size শুধু header (JPEG SOF) পড়ে; ছোট ছবি হলে decode-ই করি না
+            w, h = im.size
+            m = max(w, h)
+            if m <= MAX_SIDE:
+                return image_bytes, mime
+
+            scale = MAX_SIDE / float(m)
+            new_w, new_h = int(w * scale), int(h * scale)
 
-        scale = MAX_SIDE / float(m)
-        new_w, new_h = int(w * scale), int(h * scale)
-        img = img.resize((new_w, new_h), Image.LANCZOS)
+            # JPEG হলে libjpeg decode-এর সময়ই 1/2, 1/4, 1/8 scale করে (IDCT scaling)
+            im.draft("RGB", (new_w, new_h))
+            img = im.convert("RGB").resize((new_w, new_h), RESAMPLE)
 
         out = io.BytesIO()
         img.save(out, format="JPEG", quality=92)
-        return out.getvalue()
+        return out.getvalue(), "image/jpeg"  # resize হলে সবসময় JPEG
     except Exception:
-        return image_bytes
+        return image_bytes, mime
 
 
-def _get_state(context: ContextTypes.DEFAULT_TYPE):
+async def _get_state(context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """
-    context.user_data:
-      images: List[bytes]
+    context.user_data (or Redis imgs:{uid} / prompt:{uid}):
+      images: List[types.File]  (Gemini Files API handles)
       prompt: Optional[str]
     """
-    context.user_data.setdefault("images", [])
-    context.user_data.setdefault("prompt", None)
-    return context.user_data["images"], context.user_data["prompt"]
+    if redis_client is None:
+        context.user_data.setdefault("images", [])
+        context.user_data.setdefault("prompt", None)
+        # Redis key-এর মতো STATE_TTL পরে project বাতিল; Gemini file-ও 48h পরে মুছে যায়,
+        # তাই পুরনো handle নিয়ে generation fail করার আগেই reset করি
+        updated_at = context.user_data.get("images_updated_at")
+        if context.user_data["images"] and updated_at and time.monotonic() - updated_at > STATE_TTL:
+            log.info("Project of user %s expired; resetting", user_id)
+            context.application.create_task(_delete_uploaded_files(list(context.user_data["images"])))
+            await _reset_state(context, user_id)
+        return context.user_data["images"], context.user_data["prompt"]
+
+    raw_images, prompt = await asyncio.gather(
+        redis_client.lrange(f"imgs:{user_id}", 0, -1),
+        redis_client.get(f"prompt:{user_id}"),
+    )
+    images = [types.File.model_validate_json(x) for x in raw_images]
+    return images, prompt.decode() if prompt else None
+
+
+async def _add_image(context: ContextTypes.DEFAULT_TYPE, user_id: int, project: int, f: types.File) -> Optional[int]:
+    """Reserve করার পরে project reset (/clear) হয়ে গেলে None; ছবি নতুন project-এ ঢোকে না"""
+    if redis_client is None:
+        # কোনো await নেই, তাই project check + append atomic
+        if context.user_data.get("project", 0) != project:
+            return None
+        images = context.user_data.setdefault("images", [])
+        images.append(f)
+        context.user_data["images_updated_at"] = time.monotonic()
+        return len(images)
+
+    # শুধু file handle রাখি, raw bytes না (Redis memory bounded থাকে)
+    n = await _add_image_script(
+        keys=[f"project:{user_id}", f"imgs:{user_id}"],
+        args=[project, f.model_dump_json(include={"name", "uri", "mime_type"}), STATE_TTL],
+    )
+    return None if n < 0 else n
+
+
+async def _set_prompt(context: ContextTypes.DEFAULT_TYPE, user_id: int, prompt: str):
+    if redis_client is None:
+        context.user_data["prompt"] = prompt
+        return
+    await redis_client.set(f"prompt:{user_id}", prompt, ex=STATE_TTL)
+
+
+async def _add_image_hash(context: ContextTypes.DEFAULT_TYPE, user_id: int, h: bytes) -> bool:
+    """একই ছবি আবার এলে False (এই project-এ আগেই আছে)"""
+    if redis_client is None:
+        hashes = context.user_data.setdefault("image_hashes", set())
+        if h in hashes:
+            return False
+        hashes.add(h)
+        return True
+
+    key = f"hashes:{user_id}"
+    added = await redis_client.sadd(key, h)
+    await redis_client.expire(key, STATE_TTL)
+    return bool(added)
+
+
+async def _discard_image_hash(context: ContextTypes.DEFAULT_TYPE, user_id: int, h: bytes):
+    if redis_client is None:
+        context.user_data.setdefault("image_hashes", set()).discard(h)
+        return
+    await redis_client.srem(f"hashes:{user_id}", h)
+
+
+async def _current_project(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> int:
+    """প্রতি reset-এ project id বাড়ে; পুরনো project-এর দেরিতে শেষ হওয়া upload চেনা যায়"""
+    if redis_client is None:
+        return context.user_data.get("project", 0)
+    return int(await redis_client.get(f"project:{user_id}") or 0)
+
+
+async def _reserve_image_slot(context: ContextTypes.DEFAULT_TYPE, user_id: int, project: int) -> bool:
+    """
+    Download/upload শুরুর আগেই slot নিই: album-এর ছবিগুলো একসাথে এলেও
+    (concurrent updates) MAX_IMAGES পার হয় না। slots = images + in-flight uploads
+    """
+    if redis_client is None:
+        # কোনো await নেই, তাই check + increment atomic
+        slots = context.user_data.get("image_slots", 0)
+        if context.user_data.get("project", 0) != project or slots >= MAX_IMAGES:
+            return False
+        context.user_data["image_slots"] = slots + 1
+        return True
+
+    # slot counter project অনুযায়ী আলাদা, তাই reset-এর পরে পুরনো upload নতুন count ছোঁয় না
+    key = f"slots:{user_id}:{project}"
+    n = await redis_client.incr(key)
+    await redis_client.expire(key, STATE_TTL)
+    if n > MAX_IMAGES:
+        await redis_client.decr(key)
+        return False
+    return True
+
+
+async def _image_slots(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> int:
+    if redis_client is None:
+        return context.user_data.get("image_slots", 0)
+    project = await _current_project(context, user_id)
+    return int(await redis_client.get(f"slots:{user_id}:{project}") or 0)
+
+
+async def _release_image_slot(context: ContextTypes.DEFAULT_TYPE, user_id: int, project: int):
+    if redis_client is None:
+        if context.user_data.get("project", 0) == project:
+            context.user_data["image_slots"] = max(0, context.user_data.get("image_slots", 0) - 1)
+        return
+    key = f"slots:{user_id}:{project}"
+    if await redis_client.decr(key) < 0:
+        await redis_client.delete(key)
+
+
+async def _reset_state(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    if redis_client is None:
+        context.user_data["images"] = []
+        context.user_data["prompt"] = None
+        context.user_data["image_hashes"] = set()
+        context.user_data["image_slots"] = 0
+        context.user_data["project"] = context.user_data.get("project", 0) + 1
+        return
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.incr(f"project:{user_id}")
+        pipe.expire(f"project:{user_id}", PROJECT_TTL)
+        pipe.delete(f"imgs:{user_id}", f"prompt:{user_id}", f"hashes:{user_id}")
+        await pipe.execute()
+
 
+async def _download_to_buffer(tg_file) -> bytes:
+    """একটাই buffer-এ download; getvalue() সেই buffer share করে, আলাদা copy নেই"""
+    buf = io.BytesIO()
+    await tg_file.download_to_memory(buf)
+    return buf.getvalue()
 
-async def _download_image_bytes(update: Update) -> Optional[bytes]:
+
+async def _download_image_bytes(update: Update) -> Optional[Tuple[bytes, str]]:
+    """(bytes, mime) দেয়; mime এখানেই একবার ঠিক করি"""
     msg = update.effective_message
     if not msg:
         return None
@@ -102,24 +408,64 @@ async def _download_image_bytes(update: Update) -> Optional[bytes]:
     if msg.photo:
         best = msg.photo[-1]  # best resolution usually last
         tg_file = await best.get_file()
-        return bytes(await tg_file.download_as_bytearray())
+        # Telegram photo সবসময় JPEG
+        return await _download_to_buffer(tg_file), "image/jpeg"
 
     # Image document (send as file)
     if msg.document and (msg.document.mime_type or "").startswith("image/"):
         tg_file = await msg.document.get_file()
-        return bytes(await tg_file.download_as_bytearray())
+        buf = await _download_to_buffer(tg_file)
+        return buf, _guess_mime(buf)
 
     return None
 
 
-async def _generate_edited_image(prompt: str, image_bytes_list: List[bytes]) -> bytes:
-    parts = []
-    for b in image_bytes_list:
-        parts.append(types.Part.from_bytes(data=b, mime_type=_guess_mime(b)))
+async def _upload_image(b: bytes, mime: str) -> types.File:
+    """একবার upload করে রাখি, প্রতি prompt-এ আবার bytes পাঠাতে হবে না"""
+    return await client.aio.files.upload(
+        file=io.BytesIO(b),
+        config=types.UploadFileConfig(mime_type=mime),
+    )
+
+
+async def _delete_uploaded_files(files: List[types.File]):
+    async def _delete(f: types.File):
+        try:
+            await client.aio.files.delete(name=f.name)
+        except Exception:
+            log.warning("Failed to delete uploaded file %s", f.name)
+
+    await asyncio.gather(*(_delete(f) for f in files))
+
 
-    if not image_bytes_list:
+def _is_transient(e: Exception) -> bool:
+    # httpx-এর timeout/connection error asyncio.TimeoutError না, আলাদা ধরতে হয়
+    if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    return isinstance(e, errors.APIError) and e.code in GEMINI_RETRY_CODES
+
+
+async def _generate_content_with_retry(**kwargs):
+    for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+        try:
+            async with GEMINI_SEM:
+                return await client.aio.models.generate_content(**kwargs)
+        except Exception as e:
+            if attempt == GEMINI_MAX_ATTEMPTS or not _is_transient(e):
+                raise
+            # exponential backoff + jitter: ~1s, ~2s ... (max 10s)
+            delay = min(10.0, 2 ** (attempt - 1)) + random.uniform(0, 1)
+            log.warning("Gemini call failed (%s), retry %d/%d in %.1fs", e, attempt, GEMINI_MAX_ATTEMPTS - 1, delay)
+            await asyncio.sleep(delay)
+
+
+async def _generate_edited_image(prompt: str, files: List[types.File]) -> bytes:
+    if not files:
         raise RuntimeError("No images uploaded. Please send at least 1 image.")
 
+    # Files API URI reference: এখানে আর base64 encode করার মতো কিছু নেই
+    parts = [types.Part.from_uri(file_uri=f.uri, mime_type=f.mime_type) for f in files]
+
     instruction = (
         "Edit the FIRST provided image as the base. "
         "If more images are provided, use them only as reference. "
@@ -128,7 +474,7 @@ async def _generate_edited_image(prompt: str, image_bytes_list: List[bytes]) ->
         "Return only the edited image."
     )
 
-    resp = await client.aio.models.generate_content(
+    resp = await _generate_content_with_retry(
         model=MODEL,
         contents=parts + [instruction],
         config=types.GenerateContentConfig(response_modalities=["IMAGE"]),
@@ -136,9 +482,17 @@ async def _generate_edited_image(prompt: str, image_bytes_list: List[bytes]) ->
 
     for part in getattr(resp, "parts", []) or []:
         if part.inline_data is not None:
-            pil_img = part.as_image()
+            data = part.inline_data.data
+            # আগে থেকেই JPEG হলে আবার encode করি না
+            if part.inline_data.mime_type == "image/jpeg":
+                return data
+
+            # part.as_image() genai-এর নিজের Image model দেয়, PIL না; তাই bytes থেকে decode
+            with Image.open(io.BytesIO(data)) as im:
+                pil_img = im.convert("RGB")
+            # Telegram photo এমনিতেই re-compress করে, তাই PNG না পাঠিয়ে JPEG
             out = io.BytesIO()
-            pil_img.save(out, format="PNG")
+            pil_img.save(out, format="JPEG", quality=92, optimize=False, progressive=False)
             return out.getvalue()
 
     raise RuntimeError("No image returned (blocked/empty output). Try another prompt or image.")
@@ -158,13 +512,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def clear_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["images"] = []
-    context.user_data["prompt"] = None
+    user_id = update.effective_user.id
+    # চলমান generation-এর files মুছে ফেললে সেটা fail করবে
+    if await _is_user_locked(user_id):
+        await update.message.reply_text("⏳ Generation চলছে… শেষ হলে /clear দিন।")
+        return
+
+    images, _ = await _get_state(context, user_id)
+    context.application.create_task(_delete_uploaded_files(images), update=update)
+    await _reset_state(context, user_id)
     await update.message.reply_text("✅ Cleared. Images & prompt reset.")
 
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    images, prompt = _get_state(context)
+    images, prompt = await _get_state(context, update.effective_user.id)
     await update.message.reply_text(
         f"Images uploaded: {len(images)}/{MAX_IMAGES}\n"
         f"Prompt: {prompt if prompt else 'None'}"
@@ -172,23 +533,57 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def on_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    images, _ = _get_state(context)
+    user_id = update.effective_user.id
+    project = await _current_project(context, user_id)
 
-    if len(images) >= MAX_IMAGES:
+    if not await _reserve_image_slot(context, user_id, project):
         await update.message.reply_text(
             f"⚠️ Max {MAX_IMAGES} images reached. Use /clear to start a new project."
         )
         return
 
-    b = await _download_image_bytes(update)
-    if not b:
-        await update.message.reply_text("আমি শুধু image (photo/file) নিতে পারি।")
+    # slot নেওয়ার পরে lock দেখি: on_text lock নিয়ে in-flight slot দেখে,
+    # তাই generation-এর মাঝে project-এ নতুন ছবি ঢুকতে পারে না
+    if await _is_user_locked(user_id):
+        await _release_image_slot(context, user_id, project)
+        await update.message.reply_text("⏳ Already processing… শেষ হলে নতুন ছবি পাঠান।")
         return
 
-    b = _downscale_image_bytes(b)
-    images.append(b)
+    added = False
+    try:
+        downloaded = await _download_image_bytes(update)
+        if not downloaded or not downloaded[0]:
+            await update.message.reply_text("আমি শুধু image (photo/file) নিতে পারি।")
+            return
+
+        b, mime = downloaded
+
+        # একই ছবি দুবার পাঠালে আবার downscale/upload করি না
+        h = hashlib.sha256(b).digest()
+        if not await _add_image_hash(context, user_id, h):
+            await update.message.reply_text("ℹ️ Duplicate image ignored (already in this project).")
+            return
+
+        b, mime = await asyncio.get_running_loop().run_in_executor(DOWNSCALE_POOL, _downscale_image_bytes, b, mime)
+        try:
+            f = await _upload_image(b, mime)
+        except Exception as e:
+            log.exception("Upload failed")
+            await _discard_image_hash(context, user_id, h)
+            await update.message.reply_text(f"❌ Upload failed: {e}")
+            return
+        idx = await _add_image(context, user_id, project, f)
+        if idx is None:
+            # upload চলাকালীন /clear হয়েছে: এই ছবি পুরনো project-এর, ফেলে দিই
+            context.application.create_task(_delete_uploaded_files([f]), update=update)
+            await update.message.reply_text("ℹ️ Project cleared during upload; this image was discarded.")
+            return
+        added = True
+    finally:
+        # slot-টা এখন image নিজেই ধরে আছে; না হলে ছেড়ে দিই
+        if not added:
+            await _release_image_slot(context, user_id, project)
 
-    idx = len(images)
     await update.message.reply_text(
         f"Image {idx} received ✅\nNow send a text prompt to describe the changes."
     )
@@ -204,47 +599,76 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user_id = update.effective_user.id
-    lock = _get_lock(user_id)
 
-    images, _ = _get_state(context)
-    if len(images) == 0:
-        await msg.reply_text("আগে অন্তত 1টা ছবি পাঠান 🙂 তারপর prompt দিন।")
+    # prevent overlapping generations (lock এখানেই নিই, background task শেষ হলে ছাড়বে)
+    if not await _try_acquire_user_lock(user_id):
+        await msg.reply_text("⏳ Already processing… একটু অপেক্ষা করুন।")
         return
 
-    # prevent overlapping generations
-    if lock.locked():
-        await msg.reply_text("⏳ Already processing… একটু অপেক্ষা করুন বা /clear দিন।")
-        return
+    started = False
+    try:
+        images, _ = await _get_state(context, user_id)
+        if len(images) == 0:
+            await msg.reply_text("আগে অন্তত 1টা ছবি পাঠান 🙂 তারপর prompt দিন।")
+            return
 
-    async with lock:
-        context.user_data["prompt"] = text
+        if await _image_slots(context, user_id) > len(images):
+            await msg.reply_text("⏳ ছবি upload চলছে… একটু পরে prompt দিন।")
+            return
 
+        await _set_prompt(context, user_id, text)
         await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
         progress_msg = await msg.reply_text("Your request is progressing...")
+        started = True
+    finally:
+        if not started:
+            await _release_user_lock(user_id)
+
+    # long Gemini call handler-এর বাইরে চালাই, যাতে update polling আটকে না থাকে
+    context.application.create_task(
+        _run_generation(msg, context, user_id, progress_msg, text, list(images)),
+        update=update,
+    )
 
-        try:
-            out_png = await _generate_edited_image(text, images)
-
-            bio = io.BytesIO(out_png)
-            bio.name = "result.png"
-            bio.seek(0)
-
-            await msg.reply_photo(photo=bio, caption=f'✅ Generated: "{text}"')
-
-            # reset project (video-style)
-            context.user_data["images"] = []
-            context.user_data["prompt"] = None
-            await msg.reply_text("Process finished ✅\nSend new images to start again.")
-
-        except Exception as e:
-            log.exception("Generation failed")
-            await msg.reply_text(f"❌ Failed: {e}\nTip: /clear করে আবার চেষ্টা করুন।")
 
-        finally:
-            try:
-                await progress_msg.delete()
-            except Exception:
-                pass
+async def _run_generation(
+    msg,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    progress_msg,
+    text: str,
+    images: List[types.File],
+):
+    keeper = asyncio.create_task(_keep_user_lock(user_id))
+    try:
+        out_jpg = await _generate_edited_image(text, images)
+
+        bio = io.BytesIO(out_jpg)
+        bio.name = "result.jpg"
+        bio.seek(0)
+
+        await msg.reply_photo(photo=bio, caption=f'✅ Generated: "{text}"')
+
+        # reset project (video-style), যদি project এর মধ্যে বদলে না গিয়ে থাকে
+        current, _ = await _get_state(context, user_id)
+        if [f.name for f in current] == [f.name for f in images]:
+            context.application.create_task(_delete_uploaded_files(images))
+            await _reset_state(context, user_id)
+        else:
+            log.warning("Project of user %s changed during generation; keeping state", user_id)
+        await msg.reply_text("Process finished ✅\nSend new images to start again.")
+
+    except Exception as e:
+        log.exception("Generation failed")
+        await msg.reply_text(f"❌ Failed: {e}\nTip: /clear করে আবার চেষ্টা করুন।")
+
+    finally:
+        keeper.cancel()
+        await _release_user_lock(user_id)
+        try:
+            await progress_msg.delete()
+        except Exception:
+            pass
 
 
 async def on_other(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -252,7 +676,7 @@ async def on_other(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def main():
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("clear", clear_cmd))
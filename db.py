@@ -1,31 +1,107 @@
+import atexit
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Optional, Dict, Any
 
+DAY_MS = 86_400_000
+
+USERS_DDL = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        is_premium INTEGER DEFAULT 0,
+        credits INTEGER DEFAULT 0,
+        validity_expire_at INTEGER,
+        selected_model TEXT,
+        tts_speed TEXT,
+        created_at INTEGER,
+        updated_at INTEGER
+    )
+"""
+
+VOICES_DDL = """
+    CREATE TABLE IF NOT EXISTS voices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        file_path TEXT,
+        created_at INTEGER
+    )
+"""
+
+
+def _now_ms() -> int:
+    """All timestamps are stored as INTEGER unix epoch milliseconds (UTC)."""
+    return int(time.time() * 1000)
+
+
+def _iso_to_ms(col: str) -> str:
+    # old rows stored naive-UTC ISO strings; julianday() parses them
+    return f"CASE WHEN typeof({col}) = 'text' THEN CAST(ROUND((julianday({col}) - 2440587.5) * {DAY_MS}) AS INTEGER) ELSE {col} END"
+
 
 class Database:
+    # group commit: writes run immediately (visible to reads on this connection)
+    # but are committed at most every COMMIT_INTERVAL seconds or COMMIT_BATCH ops
+    COMMIT_INTERVAL = 0.05
+    COMMIT_BATCH = 100
+    USER_CACHE_SIZE = 4096
+
     def __init__(self, path: str):
         self.conn = sqlite3.connect(path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        self._write_lock = threading.RLock()
+        self._pending_writes = 0
+        self._closed = threading.Event()
+        # write-through caches; every mutating method invalidates what it touches.
+        # _user_cache is an LRU guarded by _write_lock, so a read can't re-cache a
+        # row that a concurrent write has already invalidated
+        self._user_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
         self._init_schema()
+        self._admin_ids = set(self.get_admins())
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="db-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.COMMIT_INTERVAL):
+            self.flush()
+
+    def _write(self, sql: str, params: tuple = ()):
+        with self._write_lock:
+            self.conn.execute(sql, params)
+            self._pending_writes += 1
+            if self._pending_writes >= self.COMMIT_BATCH:
+                self._commit()
+
+    def _commit(self):
+        self.conn.commit()
+        self._pending_writes = 0
+
+    def flush(self):
+        with self._write_lock:
+            if self._pending_writes:
+                self._commit()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
+        self.conn.close()
 
     def _init_schema(self):
         cur = self.conn.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                username TEXT,
-                is_premium INTEGER DEFAULT 0,
-                credits INTEGER DEFAULT 0,
-                validity_expire_at TEXT,
-                selected_model TEXT,
-                tts_speed TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            )
-            """
-        )
+        # WAL: readers don't block on writers, fewer fsyncs per commit
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        cur.execute("PRAGMA cache_size=-20000")
+
+        cur.execute(USERS_DDL)
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS admins (
@@ -33,16 +109,7 @@ class Database:
             )
             """
         )
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS voices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                file_path TEXT,
-                created_at TEXT
-            )
-            """
-        )
+        cur.execute(VOICES_DDL)
 
         # Migration safety: if old DB exists without tts_speed, add it.
         try:
@@ -50,58 +117,141 @@ class Database:
         except Exception:
             pass
 
+        self._migrate_timestamps(cur)
+
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_voices_user ON voices(user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS ix_users_premium ON users(is_premium, updated_at)")
+
         self.conn.commit()
 
-    def ensure_user(self, user_id: int, username: Optional[str]):
-        cur = self.conn.cursor()
-        cur.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        row = cur.fetchone()
-        now = datetime.utcnow().isoformat()
-        if not row:
-            cur.execute(
-                "INSERT INTO users (id, username, is_premium, credits, tts_speed, created_at, updated_at) VALUES (?, ?, 0, 0, ?, ?, ?)",
-                (user_id, username, "natural", now, now),
+    def _migrate_timestamps(self, cur: sqlite3.Cursor):
+        """One-shot migration: rebuild TEXT timestamp columns as INTEGER unix-ms.
+
+        A declared TEXT column would coerce integers back to strings, so the
+        tables are recreated instead of converting values in place. The rebuild
+        runs in one explicit transaction (sqlite3 would otherwise autocommit the
+        RENAME), and a leftover *_old table from an interrupted run is resumed.
+        """
+        self.conn.commit()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            self._rebuild_with_ms(
+                cur,
+                "users",
+                USERS_DDL,
+                "validity_expire_at",
+                ["id", "username", "is_premium", "credits", "validity_expire_at", "selected_model", "tts_speed", "created_at", "updated_at"],
+                {"validity_expire_at", "created_at", "updated_at"},
+            )
+            self._rebuild_with_ms(
+                cur,
+                "voices",
+                VOICES_DDL,
+                "created_at",
+                ["id", "user_id", "file_path", "created_at"],
+                {"created_at"},
             )
             self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _rebuild_with_ms(
+        self,
+        cur: sqlite3.Cursor,
+        table: str,
+        ddl: str,
+        probe: str,
+        columns: List[str],
+        ts_columns: set,
+    ):
+        old = f"{table}_old"
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (old,))
+        if cur.fetchone() is None:
+            cur.execute(f"PRAGMA table_info({table})")
+            if {r["name"]: r["type"] for r in cur.fetchall()}.get(probe) != "TEXT":
+                return
+            cur.execute(f"ALTER TABLE {table} RENAME TO {old}")
+            cur.execute(ddl)
+
+        select = ", ".join(_iso_to_ms(c) if c in ts_columns else c for c in columns)
+        cur.execute(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) SELECT {select} FROM {old}")
+        cur.execute(f"DROP TABLE {old}")
+
+    def ensure_user(self, user_id: int, username: Optional[str]):
+        now = _now_ms()
+        self._write(
+            "INSERT OR IGNORE INTO users (id, username, is_premium, credits, tts_speed, created_at, updated_at) VALUES (?, ?, 0, 0, ?, ?, ?)",
+            (user_id, username, "natural", now, now),
+        )
+        self._invalidate_user(user_id)
+
+    def _invalidate_user(self, user_id: int):
+        with self._write_lock:
+            self._user_cache.pop(user_id, None)
 
     def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        cur = self.conn.cursor()
-        cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        row = cur.fetchone()
-        return dict(row) if row else None
+        with self._write_lock:
+            user = self._user_cache.get(user_id)
+            if user is not None:
+                self._user_cache.move_to_end(user_id)
+                return dict(user)
+
+            cur = self.conn.cursor()
+            cur.execute("SELECT * FROM users WHERE id = ?", (user_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            user = self._user_cache[user_id] = dict(row)
+            if len(self._user_cache) > self.USER_CACHE_SIZE:
+                self._user_cache.popitem(last=False)
+            return dict(user)
 
     def update_user_fields(self, user_id: int, fields: Dict[str, Any]):
         if not fields:
             return
-        fields["updated_at"] = datetime.utcnow().isoformat()
+        fields["updated_at"] = _now_ms()
         keys = list(fields.keys())
         values = [fields[k] for k in keys]
         set_clause = ", ".join([f"{k} = ?" for k in keys])
-        cur = self.conn.cursor()
-        cur.execute(f"UPDATE users SET {set_clause} WHERE id = ?", (*values, user_id))
-        self.conn.commit()
+        self._write(f"UPDATE users SET {set_clause} WHERE id = ?", (*values, user_id))
+        self._invalidate_user(user_id)
 
     def add_credits(self, user_id: int, amount: int):
-        cur = self.conn.cursor()
-        cur.execute(
+        self._write(
             "UPDATE users SET credits = COALESCE(credits,0) + ?, is_premium = 1, updated_at = ? WHERE id = ?",
-            (amount, datetime.utcnow().isoformat(), user_id),
+            (amount, _now_ms(), user_id),
         )
-        self.conn.commit()
+        self._invalidate_user(user_id)
 
     def remove_credits(self, user_id: int, amount: int):
-        user = self.get_user(user_id)
-        if not user:
-            return
-        new_credits = max(0, int(user.get("credits") or 0) - amount)
-        is_premium = 1 if new_credits > 0 and self.is_valid(user_id) else 0
-        self.update_user_fields(user_id, {"credits": new_credits, "is_premium": is_premium})
+        now = _now_ms()
+        self._write(
+            """
+            UPDATE users SET
+                credits = MAX(0, COALESCE(credits,0) - ?),
+                is_premium = CASE WHEN MAX(0, COALESCE(credits,0) - ?) > 0 AND validity_expire_at > ? THEN 1 ELSE 0 END,
+                updated_at = ?
+            WHERE id = ?
+            """,
+            (amount, amount, now, now, user_id),
+        )
+        self._invalidate_user(user_id)
 
     def set_validity(self, user_id: int, days: int):
-        expire_at = (datetime.utcnow() + timedelta(days=days)).isoformat()
-        user = self.get_user(user_id)
-        is_premium = 1 if (user and (user.get("credits") or 0) > 0) else 0
-        self.update_user_fields(user_id, {"validity_expire_at": expire_at, "is_premium": is_premium})
+        now = _now_ms()
+        expire_at = now + days * DAY_MS
+        self._write(
+            """
+            UPDATE users SET
+                validity_expire_at = ?,
+                is_premium = CASE WHEN COALESCE(credits,0) > 0 THEN 1 ELSE 0 END,
+                updated_at = ?
+            WHERE id = ?
+            """,
+            (expire_at, now, user_id),
+        )
+        self._invalidate_user(user_id)
 
     def remove_validity(self, user_id: int):
         self.update_user_fields(user_id, {"validity_expire_at": None, "is_premium": 0})
@@ -111,12 +261,7 @@ class Database:
         if not user:
             return False
         exp = user.get("validity_expire_at")
-        if not exp:
-            return False
-        try:
-            return datetime.fromisoformat(exp) > datetime.utcnow()
-        except Exception:
-            return False
+        return bool(exp) and exp > _now_ms()
 
     def list_users(self, limit: int = 100) -> List[Dict[str, Any]]:
         cur = self.conn.cursor()
@@ -137,12 +282,10 @@ class Database:
         return [dict(r) for r in rows]
 
     def store_voice(self, user_id: int, file_path: str):
-        cur = self.conn.cursor()
-        cur.execute(
+        self._write(
             "INSERT INTO voices (user_id, file_path, created_at) VALUES (?, ?, ?)",
-            (user_id, file_path, datetime.utcnow().isoformat()),
+            (user_id, file_path, _now_ms()),
         )
-        self.conn.commit()
 
     def list_user_voices(self, user_id: int) -> List[Dict[str, Any]]:
         cur = self.conn.cursor()
@@ -151,9 +294,7 @@ class Database:
         return [dict(r) for r in rows]
 
     def delete_user_voices(self, user_id: int):
-        cur = self.conn.cursor()
-        cur.execute("DELETE FROM voices WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        self._write("DELETE FROM voices WHERE user_id = ?", (user_id,))
 
     def get_admins(self) -> List[int]:
         cur = self.conn.cursor()
@@ -162,16 +303,12 @@ class Database:
         return [int(r[0]) for r in rows]
 
     def add_admin(self, user_id: int):
-        cur = self.conn.cursor()
-        cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-        self.conn.commit()
+        self._write("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+        self._admin_ids.add(user_id)
 
     def remove_admin(self, user_id: int):
-        cur = self.conn.cursor()
-        cur.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-        self.conn.commit()
+        self._write("DELETE FROM admins WHERE user_id = ?", (user_id,))
+        self._admin_ids.discard(user_id)
 
     def is_admin(self, user_id: int) -> bool:
-        cur = self.conn.cursor()
-        cur.execute("SELECT user_id FROM admins WHERE user_id = ?", (user_id,))
-        return cur.fetchone() is not None
+        return user_id in self._admin_ids